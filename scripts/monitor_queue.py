@@ -9,24 +9,104 @@
 """
 
 import argparse
+import bisect
 import json
+import mmap
 import sys
 import time
+from array import array
 from datetime import datetime, timedelta
 from pathlib import Path
 
 # Добавляем корневую папку проекта в путь
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from xapi_bridge import settings
+from xapi_bridge import fastjson, settings
+from xapi_bridge.retry_queue import default_queue_path, index_path_for, read_index_file
 
 
 class QueueMonitor:
     """Мониторинг очереди повторных попыток."""
     
     def __init__(self):
-        self.queue_path = Path(getattr(settings, 'RETRY_QUEUE_FILE', '.retry_queue.jsonl'))
+        # Тот же путь, что использует RetryQueue, включая значение по умолчанию
+        self.queue_path = Path(getattr(settings, 'RETRY_QUEUE_FILE', None) or default_queue_path())
         self.sink_path = Path(getattr(settings, 'RETRY_SINK_FILE', 'retried.jsonl'))
+        # Результаты последнего чтения файлов: в режиме --watch неизменившиеся
+        # файлы не перечитываются, а у sink-файла дочитывается только хвост
+        self._cache = {}
+    
+    def _scan_queue(self, st):
+        """Возвращает (число записей, отсортированные ready_at, признак оценки) очереди.
+        
+        Если индекс очереди актуален, статистика берётся из него — это учитывает
+        только живые записи и не требует разбора JSON. Иначе сканируется сам файл,
+        и результат — оценка сверху: выданные, но ещё не убранные уплотнением строки
+        остаются в файле и тоже попадают в счёт.
+        """
+        index_path = index_path_for(self.queue_path)
+        try:
+            index_st = index_path.stat()
+            index_key = (index_st.st_ino, index_st.st_size, index_st.st_mtime_ns)
+        except FileNotFoundError:
+            index_key = None
+        key = (st.st_ino, st.st_size, st.st_mtime_ns, index_key)
+        cached = self._cache.get('queue')
+        if cached and cached['key'] == key:
+            return cached['count'], cached['ready_at'], cached['estimated']
+        
+        entries, covered, ino = read_index_file(index_path) if index_key else (None, 0, 0)
+        if entries is not None and ino == st.st_ino and covered == st.st_size:
+            ready_at = array('q', sorted(entry[0] for entry in entries))
+            self._cache['queue'] = {'key': key, 'count': len(entries), 'ready_at': ready_at, 'estimated': False}
+            return len(entries), ready_at, False
+        
+        count = 0
+        ready_at = []
+        if st.st_size:
+            # Режем файл по b'\n' прямо в mmap, без построчного чтения и strip()
+            with open(self.queue_path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                size = len(mm)
+                pos = 0
+                while pos < size:
+                    end = mm.find(b'\n', pos)
+                    if end == -1:
+                        end = size
+                    count += 1
+                    if end > pos:
+                        try:
+                            record = fastjson.loads(view[pos:end])
+                            ready_at.append(int(record.get('ready_at', 0)))
+                        except fastjson.JSONDecodeError:
+                            pass
+                    pos = end + 1
+                view.release()
+        
+        ready_at = array('q', sorted(ready_at))
+        self._cache['queue'] = {'key': key, 'count': count, 'ready_at': ready_at, 'estimated': True}
+        return count, ready_at, True
+    
+    def _count_sink(self, st):
+        """Считает строки sink-файла, дочитывая только добавленный хвост."""
+        cached = self._cache.get('sink')
+        if cached and cached['ino'] == st.st_ino and cached['offset'] <= st.st_size:
+            offset = cached['offset']
+            records = cached['records']
+        else:
+            offset = 0
+            records = 0
+        
+        if offset < st.st_size:
+            with open(self.sink_path, 'rb') as f:
+                f.seek(offset)
+                for _ in f:
+                    records += 1
+                offset = f.tell()
+        
+        self._cache['sink'] = {'ino': st.st_ino, 'offset': offset, 'records': records}
+        return records
     
     def get_queue_stats(self):
         """Получает статистику очереди."""
@@ -39,50 +119,28 @@ class QueueMonitor:
             'sink_size_bytes': 0,
             'oldest_record_age': None,
             'newest_record_age': None,
+            'queue_estimated': False,
         }
         
         # Проверяем очередь
         if self.queue_path.exists():
-            with open(self.queue_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            stats['queue_records'] = len(lines)
-            stats['queue_size_bytes'] = self.queue_path.stat().st_size
+            st = self.queue_path.stat()
+            stats['queue_size_bytes'] = st.st_size
+            stats['queue_records'], ready_at, stats['queue_estimated'] = self._scan_queue(st)
             
             current_time = time.time()
-            record_ages = []
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                try:
-                    record = json.loads(line)
-                    ready_at = record.get('ready_at', 0)
-                    age = current_time - ready_at
-                    record_ages.append(age)
-                    
-                    if age > (3600*24):  # Старше суток
-                        stats['old_records'] += 1
-                    
-                    if ready_at <= current_time:
-                        stats['ready_records'] += 1
-                        
-                except json.JSONDecodeError:
-                    continue
-            
-            if record_ages:
-                stats['oldest_record_age'] = max(record_ages)
-                stats['newest_record_age'] = min(record_ages)
+            # ready_at отсортированы: старые и готовые записи — это префиксы массива
+            stats['old_records'] = bisect.bisect_left(ready_at, current_time - 3600*24)  # Старше суток
+            stats['ready_records'] = bisect.bisect_right(ready_at, current_time)
+            if ready_at:
+                stats['oldest_record_age'] = current_time - ready_at[0]
+                stats['newest_record_age'] = current_time - ready_at[-1]
         
-        # Проверяем файл результатов
+        # Проверяем файл результатов: строки только считаем, не разбирая JSON
         if self.sink_path.exists():
-            with open(self.sink_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            stats['sink_records'] = len(lines)
-            stats['sink_size_bytes'] = self.sink_path.stat().st_size
+            st = self.sink_path.stat()
+            stats['sink_size_bytes'] = st.st_size
+            stats['sink_records'] = self._count_sink(st)
         
         return stats
     
@@ -104,6 +162,9 @@ class QueueMonitor:
         print(f"  Готовых к обработке: {stats['ready_records']}")
         print(f"  Старых записей (>1ч): {stats['old_records']}")
         print(f"  Размер файла: {stats['queue_size_bytes']} байт")
+        if stats['queue_estimated']:
+            print("  Индекс очереди недоступен: числа — оценка сверху, в них входят")
+            print("  уже отправленные записи, которые ещё не убраны уплотнением")
         
         if stats['oldest_record_age'] is not None:
             oldest_hours = stats['oldest_record_age'] / 3600
@@ -427,20 +427,29 @@ def main():
     args = parse_args()
     setup_logging()
 
-    # Фоновый воркер для повторной отправки из очереди
-    retry_worker = RetryQueueWorker()
+    # Фоновый воркер для повторной отправки из очереди (общий с публикатором экземпляр очереди)
+    retry_queue = client.lrs_publisher.retry_queue
+    retry_worker = RetryQueueWorker(queue=retry_queue)
     retry_worker.start()
 
-    if args.historical_logs_dir:
-        process_gzipped_logs(args.historical_logs_dir, args.historical_logs_dates)
-        return
+    try:
+        if args.historical_logs_dir:
+            process_gzipped_logs(args.historical_logs_dir, args.historical_logs_dates)
+            return
 
-    if settings.HTTP_PUBLISH_STATUS:
-        server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
-        server_thread.start()
+        if settings.HTTP_PUBLISH_STATUS:
+            server_thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+            server_thread.start()
 
-    watchfile = args.watchfile or settings.TRACKING_LOG
-    watch(watchfile)
+        watchfile = args.watchfile or settings.TRACKING_LOG
+        watch(watchfile)
+    finally:
+        # Останавливаем воркер и закрываем файлы очереди; если воркер не успел
+        # завершить отправку, очередь не закрываем — процесс всё равно завершается
+        retry_worker.stop()
+        retry_worker.join(timeout=30)
+        if not retry_worker.is_alive():
+            retry_queue.close()
 
 
 if __name__ == '__main__':
@@ -22,6 +22,7 @@ from tincan.lrs_response import LRSResponse
 
 import xapi_bridge.exceptions as exceptions
 from xapi_bridge import settings
+from xapi_bridge.constants import LRS_RETRYABLE_STATUSES
 from xapi_bridge.lrs_backends.learninglocker import LRSBackend
 from xapi_bridge.retry_queue import RetryQueue
 
@@ -190,15 +191,17 @@ class XAPIBridgeLRSPublisher:
         response_data_str = json.dumps(response_data) if isinstance(response_data, dict) else str(response_data)
         logger.debug(response_data_str)
 
-        if self.backend.request_unauthorised(response_data_str):
+        classification = self.backend.classify(response_data_str)
+
+        if classification.unauthorised:
             error_msg = "Ошибка авторизации в LRS"
             raise exceptions.XAPIBridgeLRSConnectionError(
                 endpoint=settings.LRS_ENDPOINT,
                 status_code=None
             )
 
-        if self.backend.response_has_storage_errors(response_data_str):
-            bad_index = self.backend.parse_error_response_for_bad_statement(response_data_str)
+        if classification.storage_errors:
+            bad_index = classification.bad_statement_index
             bad_statement = statements[bad_index] if bad_index is not None else None
             error_msg = (f"Ошибка сохранения высказывания: {response_data.get('message', '')} ",
                         f"- {response_data_str} - {response.request.content}")
@@ -217,10 +220,8 @@ class XAPIBridgeLRSPublisher:
         # Если 404 — откладываем на повтор
         status_code = getattr(response.response, 'status', None)
         if self.backend.is_not_found(status_code, response_data_str):
-            # сохраняем JSON контент запроса без повторной сериализации
+            # сохраняем JSON контент запроса без повторной сериализации и перекодирования
             content = response.request.content
-            if isinstance(content, (bytes, bytearray)):
-                content = content.decode('utf-8', errors='ignore')
             try:
                 self.retry_queue.enqueue(content)
             except Exception:
@@ -232,11 +233,8 @@ class XAPIBridgeLRSPublisher:
             )
 
         # Повторяемые статусы: 408/429/5xx
-        retryable_statuses = {408, 429, 500, 502, 503, 504}
-        if status_code in retryable_statuses:
+        if status_code in LRS_RETRYABLE_STATUSES:
             content = response.request.content
-            if isinstance(content, (bytes, bytearray)):
-                content = content.decode('utf-8', errors='ignore')
             delay_seconds = None
             # Учитываем Retry-After, если возможно получить
             try:
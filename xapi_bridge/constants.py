@@ -49,5 +49,8 @@ OPENEDX_OAUTH2_TOKEN_URL = "/oauth2/access_token"
 BLOCK_OBJECT_ID_FORMAT = "{platform}/xblock/{block_usage_key}"
 ENROLLMENT_API_URL_FORMAT = "/api/enrollment/v1/enrollment/{username},{course_id}"
 
+# HTTP-статусы LRS, при которых отправка откладывается в очередь ретраев
+LRS_RETRYABLE_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
 # Video Profile (Профиль видео)
 VIDEO_PROFILE = "https://w3id.org/xapi/video"
@@ -0,0 +1,35 @@
+"""
+Быстрая (де)сериализация JSON для файловых очередей.
+
+Использует orjson (зависимость из requirements/base.txt); стандартный json —
+лишь запасной вариант на случай, если orjson не удалось установить.
+Функции работают с байтами, чтобы файлы можно было читать и писать
+в двоичном режиме без перекодирования.
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - запасной вариант без orjson
+    orjson = None
+
+
+JSONDecodeError = orjson.JSONDecodeError if orjson else json.JSONDecodeError
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Разбирает JSON из байтов или строки."""
+    if orjson:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Сериализует объект в компактный JSON (UTF-8, без экранирования не-ASCII)."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
@@ -4,7 +4,35 @@
 """
 
 from abc import ABC, abstractmethod
-from typing import Any
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Optional
+
+from xapi_bridge import fastjson
+
+
+@dataclass(frozen=True)
+class ResponseClassification:
+    """Результат однократного разбора ответа LRS."""
+
+    unauthorised: bool
+    has_errors: bool
+    storage_errors: bool
+    bad_statement_index: Optional[int] = None
+
+
+@lru_cache(maxsize=32)
+def parse_response_data(response_data: str) -> Any:
+    """
+    Разбирает JSON-ответ LRS.
+
+    Проверки бэкенда вызываются подряд для одного и того же ответа, поэтому
+    результат кэшируется по строке ответа. Возвращаемый объект общий — не изменять.
+
+    Raises:
+        json.JSONDecodeError: Ответ не является JSON
+    """
+    return fastjson.loads(response_data)
 
 
 class LRSBackendBase(ABC):
@@ -65,6 +93,29 @@ class LRSBackendBase(ABC):
             XAPIBridgeLRSBackendResponseParseError: Ошибка парсинга ответа
         """
 
+    def classify(self, response_data: Any) -> ResponseClassification:
+        """
+        Выполняет все проверки ответа за один вызов.
+
+        Args:
+            response_data: Данные ответа от LRS
+
+        Returns:
+            ResponseClassification с результатами проверок; индекс проблемного
+            высказывания определяется только для ошибок хранения без ошибки авторизации
+        """
+        unauthorised = self.request_unauthorised(response_data)
+        storage_errors = self.response_has_storage_errors(response_data)
+        bad_statement_index = None
+        if storage_errors and not unauthorised:
+            bad_statement_index = self.parse_error_response_for_bad_statement(response_data)
+        return ResponseClassification(
+            unauthorised=unauthorised,
+            has_errors=self.response_has_errors(response_data),
+            storage_errors=storage_errors,
+            bad_statement_index=bad_statement_index,
+        )
+
     def is_not_found(self, status_code: int, response_data: Any) -> bool:
         """Возвращает True, если ответ указывает на 404 Not Found.
 
@@ -7,7 +7,7 @@ import json
 import re
 from typing import Any, Dict, Optional
 
-from .base import LRSBackendBase
+from .base import LRSBackendBase, parse_response_data
 from xapi_bridge import exceptions
 
 
@@ -28,7 +28,7 @@ class LRSBackend(LRSBackendBase):
             XAPIBridgeLRSBackendResponseParseError: Ошибка парсинга ответа
         """
         try:
-            error = json.loads(response_data)
+            error = parse_response_data(response_data)
             warnings = error.get('warnings', [])
 
             if not warnings:
@@ -48,7 +48,7 @@ class LRSBackend(LRSBackendBase):
     def response_has_errors(self, response_data: str) -> bool:
         """Проверяет наличие ошибок в ответе LRS."""
         try:
-            data = json.loads(response_data)
+            data = parse_response_data(response_data)
             return 'errorId' in data
         except json.JSONDecodeError:
             return False
@@ -56,7 +56,7 @@ class LRSBackend(LRSBackendBase):
     def request_unauthorised(self, response_data: str) -> bool:
         """Проверяет статус авторизации."""
         try:
-            data = json.loads(response_data)
+            data = parse_response_data(response_data)
             return data.get('message') == 'Unauthorised'
         except json.JSONDecodeError:
             return False
@@ -64,7 +64,7 @@ class LRSBackend(LRSBackendBase):
     def response_has_storage_errors(self, response_data: str) -> bool:
         """Проверяет наличие ошибок хранения данных."""
         try:
-            data = json.loads(response_data)
+            data = parse_response_data(response_data)
             return 'warnings' in data
         except json.JSONDecodeError:
             return False
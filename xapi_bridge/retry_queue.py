@@ -2,37 +2,393 @@
 Файловая очередь для отложенной повторной отправки высказываний.
 """
 
-import json
+import bisect
+import contextlib
+import fcntl
+import functools
 import logging
+import mmap
+import os
+import struct
 import threading
 import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple, Union
 
+from pyinotify import EventsCodes, ProcessEvent, ThreadedNotifier, WatchManager
 from tincan.lrs_response import LRSResponse
 
-from xapi_bridge import settings
+from xapi_bridge import fastjson, settings
+from xapi_bridge.constants import LRS_RETRYABLE_STATUSES
 
 
 logger = logging.getLogger(__name__)
 
+# Наибольший объём, читаемый из файла очереди одним pread
+_READ_WINDOW = 8 * 1024 * 1024
 
-def _default_queue_path() -> Path:
+# Формат файла индекса: заголовок (inode файла очереди, его размер на момент записи
+# индекса), далее записи (ready_at, offset, length). Записи только дописываются:
+# выданная из очереди строка отмечается записью-надгробием с length = _TOMBSTONE,
+# а целиком индекс перезаписывается лишь при уплотнении очереди
+_INDEX_HEADER = struct.Struct('<qq')
+_INDEX_ENTRY = struct.Struct('<qqq')
+_TOMBSTONE = -1
+
+@functools.lru_cache(maxsize=None)
+def default_queue_path() -> Path:
+    """Путь очереди по умолчанию (~/.xapi_bridge_retry.jsonl).
+
+    Вычисляется при первом обращении, а не при импорте: без $HOME Path.home()
+    обращается к базе пользователей (getpwuid) и падает, если uid в ней нет,
+    хотя при заданном RETRY_QUEUE_FILE путь по умолчанию не нужен.
+    """
+    return Path.home() / '.xapi_bridge_retry.jsonl'
+
+
+def _queue_path() -> Path:
     custom = getattr(settings, 'RETRY_QUEUE_FILE', None)
     if custom:
         return Path(custom)
-    return Path.home() / '.xapi_bridge_retry.jsonl'
+    return default_queue_path()
+
+
+def _pread_full(fd: int, size: int, offset: int) -> bytes:
+    """Читает size байт с offset, повторяя pread: один вызов может вернуть меньше.
+
+    Короче size результат бывает только у конца файла.
+    """
+    chunks = []
+    while size > 0:
+        chunk = os.pread(fd, size, offset)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+        offset += len(chunk)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+def index_path_for(queue_path: Path) -> Path:
+    """Путь к файлу индекса рядом с файлом очереди."""
+    return queue_path.with_name(queue_path.name + '.idx')
+
+
+def _index_data_size(size: int) -> int:
+    """Размер файла индекса без оборванной последней записи."""
+    if size < _INDEX_HEADER.size:
+        return size
+    return size - (size - _INDEX_HEADER.size) % _INDEX_ENTRY.size
+
+
+def read_index_file(path: Path) -> Tuple[Optional[List[Tuple[int, int, int]]], int, int]:
+    """
+    Читает файл индекса очереди.
+
+    Оборванная последняя запись (сбой посреди дозаписи) отбрасывается, а все целые
+    записи, включая надгробия, сохраняются: иначе пришлось бы пересканировать файл
+    очереди, и выданные, но ещё не уплотнённые строки снова считались бы живыми.
+
+    Returns:
+        (живые записи индекса, размер покрытой индексом части файла очереди,
+        inode файла очереди, для которого построен индекс);
+        (None, 0, 0), если индекса нет или нет даже заголовка
+    """
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None, 0, 0
+    if len(data) < _INDEX_HEADER.size:
+        return None, 0, 0
+    ino, covered = _INDEX_HEADER.unpack_from(data)
+    entries = {}
+    body = memoryview(data)[_INDEX_HEADER.size:_index_data_size(len(data))]
+    for entry in _INDEX_ENTRY.iter_unpack(body):
+        _, offset, length = entry
+        if length == _TOMBSTONE:
+            entries.pop(offset, None)
+        else:
+            entries[offset] = entry
+            covered = max(covered, offset + length + 1)
+    return list(entries.values()), covered, ino
+
+
+class _IndexChangeHandler(ProcessEvent):
+    """Будит ожидающих в RetryQueue.wait_pending при изменении файла индекса."""
+
+    # Следим за каталогом: при уплотнении файл индекса заменяется через os.replace
+    MASK = EventsCodes.OP_FLAGS['IN_MODIFY'] | EventsCodes.OP_FLAGS['IN_MOVED_TO']
+
+    def __init__(self, queue: 'RetryQueue', **kwargs):
+        super().__init__(**kwargs)
+        self.queue = queue
+        self.filename = str(queue.index_path)
+
+    def process_default(self, event) -> None:
+        if event.pathname == self.filename:
+            self.queue.wake()
+
+    def process_IN_Q_OVERFLOW(self, event) -> None:
+        # события потеряны — пусть ожидающие перепроверят очередь сами
+        self.queue.wake()
 
 
 class RetryQueue:
-    """Простая JSONL-очередь. Каждая строка — JSON с полями content, ready_at."""
+    """JSONL-очередь с индексом.
+
+    Каждая строка файла — JSON с полями content, ready_at. Файл только дописывается,
+    а индекс (ready_at, offset, length), отсортированный по ready_at, позволяет
+    читать готовые записи по смещениям, не перечитывая и не перезаписывая весь файл.
+    Выданные записи остаются в файле «мёртвыми» байтами, пока их доля не превысит
+    COMPACT_RATIO — тогда файл уплотняется.
 
-    def __init__(self) -> None:
-        self.path = _default_queue_path()
+    Индекс хранится в двоичном файле рядом с очередью (index_path_for), поэтому
+    при старте JSON разбирается только для строк, дописанных после его сохранения.
+
+    Файл могут дописывать и читать несколько экземпляров и процессов (например,
+    основной бридж и обработка исторических логов с той же очередью по умолчанию):
+    все операции выполняются под flock на файле <очередь>.lock, а перед каждой
+    экземпляр сверяет свой индекс с файлами (_sync) и подхватывает чужие изменения.
+    """
+
+    # Доля мёртвых байт в файле, после которой он перезаписывается
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, path: Optional[Union[str, Path]] = None) -> None:
+        self.path = Path(path) if path else _queue_path()
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.dead_path = self.path.with_name(self.path.name + '.dead')
+        self.index_path = index_path_for(self.path)
         self.lock = threading.Lock()
+        # Сигнал «в очереди появились записи» для воркера, ожидающего на пустой очереди
+        self._not_empty = threading.Condition(self.lock)
+        self._index: List[Tuple[int, int, int]] = []
+        self._size = 0
+        self._live_bytes = 0
+        # Слежение за файлом индекса (inotify), запускается первым wait_pending
+        self._watcher: Optional[ThreadedNotifier] = None
+        # Файл межпроцессной блокировки не заменяется при уплотнении, в отличие от очереди
+        self._lock_fd = os.open(self.path.with_name(self.path.name + '.lock'),
+                                os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        # Один дескриптор O_APPEND на всё время жизни файла: запись строки — один write()
+        self._fd = -1
+        self._index_fd = -1
+        try:
+            with self.lock, self._file_lock(sync=False):
+                self._reopen()
+                self._load_index()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        """Закрывает файлы очереди. Повторный вызов ничего не делает."""
+        with self.lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            # вне self.lock: обработчик событий сам берёт эту блокировку в wake()
+            watcher.stop()
+        with self.lock:
+            for fd in (self._fd, self._index_fd, self._lock_fd):
+                if fd >= 0:
+                    os.close(fd)
+            self._fd = self._index_fd = self._lock_fd = -1
+
+    def __enter__(self) -> 'RetryQueue':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @staticmethod
+    def _open_append(path: Path) -> int:
+        return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+
+    def _reopen(self) -> None:
+        """Открывает файлы очереди и индекса заново (после замены их другим экземпляром)."""
+        for fd in (self._fd, self._index_fd):
+            if fd >= 0:
+                os.close(fd)
+        self._fd = self._open_append(self.path)
+        self._index_fd = self._open_append(self.index_path)
+        self._ino = os.fstat(self._fd).st_ino
+        self._index_ino = os.fstat(self._index_fd).st_ino
+        self._index_size = 0
+
+    @contextlib.contextmanager
+    def _file_lock(self, sync: bool = True) -> Iterator[None]:
+        """Межпроцессная блокировка файла очереди. Берётся под self.lock.
+
+        При sync=True индекс экземпляра перед этим сверяется с файлами.
+        """
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            if sync:
+                self._sync()
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        """Подхватывает изменения файлов, сделанные другими экземплярами. Вызывается под блокировками."""
+        try:
+            st = os.stat(self.path)
+            index_st = os.stat(self.index_path)
+        except FileNotFoundError:
+            st = index_st = None
+        if index_st is not None:
+            index_size = _index_data_size(index_st.st_size)
+            if index_size != index_st.st_size:
+                # оборванную запись упавшего писателя отрезаем, чтобы следующие дозаписи
+                # не сместились относительно границ записей
+                os.truncate(self.index_path, index_size)
+        if (
+            st is None or st.st_ino != self._ino or st.st_size < self._size
+            or index_st.st_ino != self._index_ino or index_size < self._index_size
+        ):
+            # файл уплотнён или индекс перезаписан другим экземпляром — перечитываем индекс
+            self._reopen()
+            self._load_index()
+            return
+        if index_size > self._index_size or st.st_size > self._size:
+            self._catch_up(index_size, st.st_size)
+
+    def _catch_up(self, index_size: int, size: int) -> None:
+        """Применяет к индексу экземпляра изменения, дописанные другими экземплярами.
+
+        Записи и надгробия берутся из хвоста файла индекса; строки очереди между
+        записями, не попавшие в индекс (писатель упал между записью строки и индекса),
+        доиндексируются сканом.
+        """
+        known: List[Tuple[int, int, int]] = []
+        if index_size > self._index_size:
+            with open(self.index_path, 'rb') as f:
+                f.seek(self._index_size)
+                data = f.read(index_size - self._index_size)
+            self._index_size = index_size
+            # записи индекса пишутся целиком одним write() под flock
+            dropped = set()
+            for entry in _INDEX_ENTRY.iter_unpack(data):
+                if entry[2] == _TOMBSTONE:
+                    dropped.add(entry[:2])
+                else:
+                    known.append(entry)
+            known.sort(key=lambda entry: entry[1])
+            for entry in known:
+                bisect.insort(self._index, entry)
+                self._live_bytes += entry[2] + 1
+            if dropped:
+                # записи, выданные другими экземплярами
+                index = []
+                for entry in self._index:
+                    if entry[:2] in dropped:
+                        self._live_bytes -= entry[2] + 1
+                    else:
+                        index.append(entry)
+                self._index = index
+        lost: List[Tuple[int, int, int]] = []
+        pos = self._size
+        for _, offset, length in known:
+            if offset > pos:
+                lost.extend(self._scan(pos, offset)[0])
+            pos = max(pos, offset + length + 1)
+        if size > pos:
+            tail, size = self._scan(pos, size)
+            lost.extend(tail)
+        self._size = max(pos, size)
+        self._append_index(lost)
+
+    def _append_index(self, entries: List[Tuple[int, int, int]]) -> None:
+        """Добавляет записи в индекс экземпляра и дописывает их в файл индекса."""
+        if not entries:
+            return
+        data = b''.join(_INDEX_ENTRY.pack(*entry) for entry in entries)
+        os.write(self._index_fd, data)
+        self._index_size += len(data)
+        for entry in entries:
+            bisect.insort(self._index, entry)
+            self._live_bytes += entry[2] + 1
+
+    def _drop_entries(self, entries: List[Tuple[int, int, int]]) -> None:
+        """Отмечает выданные записи надгробиями в файле индекса — одним write()."""
+        if not entries:
+            return
+        data = b''.join(_INDEX_ENTRY.pack(ready_at, offset, _TOMBSTONE) for ready_at, offset, _ in entries)
+        os.write(self._index_fd, data)
+        self._index_size += len(data)
+        self._live_bytes -= sum(length + 1 for _, _, length in entries)
+
+    def _load_index(self) -> None:
+        """Загружает индекс из файла и доиндексирует хвост очереди, не попавший в него."""
+        size = os.fstat(self._fd).st_size
+        index, covered, ino = read_index_file(self.index_path)
+        stale = index is None or ino != self._ino or covered != size
+        if index is None or ino != self._ino or covered > size:
+            # индекса нет или он от другой версии файла (например, сбой между заменой
+            # файла очереди при уплотнении и записью нового индекса)
+            index, covered = [], 0
+        if covered < size:
+            tail, size = self._scan(covered, size)
+            index.extend(tail)
+        index.sort()
+        self._index = index
+        self._size = size
+        self._live_bytes = sum(length + 1 for _, _, length in index)
+        if stale:
+            self._save_index()
+        else:
+            index_size = os.fstat(self._index_fd).st_size
+            self._index_size = _index_data_size(index_size)
+            if self._index_size != index_size:
+                os.ftruncate(self._index_fd, self._index_size)
+
+    def _scan(self, start: int, size: int) -> Tuple[List[Tuple[int, int, int]], int]:
+        """Индексирует строки файла очереди от start до size; возвращает записи и новый размер."""
+        entries: List[Tuple[int, int, int]] = []
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            while pos < size:
+                end = mm.find(b'\n', pos, size)
+                if end == -1:
+                    end = size
+                try:
+                    rec = fastjson.loads(mm[pos:end])
+                    ready_at = int(rec.get('ready_at', 0))
+                    if rec.get('content'):
+                        entries.append((ready_at, pos, end - pos))
+                except Exception:
+                    # сломанные строки не индексируем, при уплотнении они отбрасываются
+                    pass
+                pos = end + 1
+            # оборванной может быть только последняя строка файла
+            truncated = size == len(mm) and mm[size - 1] != ord('\n')
+        if truncated:
+            # оборванную последнюю строку закрываем, чтобы не склеить её со следующей записью
+            os.write(self._fd, b'\n')
+            size += 1
+        return entries, size
 
-    def enqueue(self, content_json: str, delay_seconds: Optional[int] = None) -> None:
+    def _save_index(self) -> None:
+        """Перезаписывает файл индекса текущим состоянием. Вызывается под блокировками."""
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        buf = bytearray(_INDEX_HEADER.pack(self._ino, self._size))
+        for entry in self._index:
+            buf += _INDEX_ENTRY.pack(*entry)
+        with open(tmp_path, 'wb') as out:
+            out.write(buf)
+        os.replace(tmp_path, self.index_path)
+        os.close(self._index_fd)
+        self._index_fd = self._open_append(self.index_path)
+        self._index_ino = os.fstat(self._index_fd).st_ino
+        self._index_size = len(buf)
+
+    def enqueue(self, content_json: Union[str, bytes, list], delay_seconds: Optional[int] = None) -> None:
+        """Добавляет в очередь высказывания: JSON (строка или байты) либо уже разобранный список.
+
+        Raises:
+            ValueError: содержимое не является корректным JSON в UTF-8
+        """
         # В ежедневном режиме задержка не используется: запись должна быть готова к ближайшему окну
         if getattr(settings, 'RETRY_DAILY_AT', None):
             ready_at = int(time.time())
@@ -40,63 +396,209 @@ class RetryQueue:
             # Периодический режим (на случай локальных тестов)
             retry_delay = int(getattr(settings, 'RETRY_DELAY_SECONDS', 0) or 0)
             ready_at = int(time.time()) + int(delay_seconds or retry_delay)
-        record = {'content': content_json, 'ready_at': ready_at}
-        line = json.dumps(record, ensure_ascii=False)
-        with self.lock:
-            with open(self.path, 'a', encoding='utf-8') as f:
-                f.write(line + '\n')
-        logger.info(f"Добавлено в очередь повторной отправки. ready_at={ready_at}")
+        # Содержимое встраивается в запись как JSON-значение, а не строка: при чтении
+        # один разбор строки очереди сразу даёт список высказываний
+        if isinstance(content_json, list):
+            content = fastjson.dumps(content_json)
+        else:
+            # байты (например, тело запроса к LRS) пишутся как есть, без перекодирования,
+            # но сначала проверяются: иначе в файл попадёт строка, которую не прочитать
+            if isinstance(content_json, str):
+                content_json = content_json.encode('utf-8')
+            content = bytes(content_json)
+            try:
+                parsed = fastjson.loads(content)
+            except ValueError as e:
+                raise ValueError(f"Содержимое для очереди повторной отправки не является JSON: {e}") from e
+            # LRS принимает списки высказываний, и дальше по конвейеру содержимое всегда список
+            if not isinstance(parsed, list):
+                parsed = [parsed]
+                content = b'[' + content + b']'
+            if b'\n' in content:
+                # перевод строки вне JSON-строк — это форматирование; сжимаем, чтобы не разорвать JSONL
+                content = fastjson.dumps(parsed)
+        line = b'{"content":%b,"ready_at":%d}\n' % (content, ready_at)
+        # Сама дозапись атомарна благодаря O_APPEND; блокировки нужны, чтобы смещение
+        # в индексе совпало с концом файла, который могли дописать другие экземпляры
+        with self.lock, self._file_lock():
+            offset = self._size
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._append_index([(ready_at, offset, len(line) - 1)])
+            self._not_empty.notify_all()
+        logger.debug("Добавлено в очередь повторной отправки. ready_at=%s", ready_at)
+
+    def wait_pending(self, stop_event: threading.Event) -> bool:
+        """Блокирует, пока очередь пуста.
+
+        Записи этого экземпляра будят ожидание через Condition, а записи других
+        экземпляров и процессов — через inotify на файле индекса, который они дописывают.
+
+        Returns:
+            False, если ожидание прервано установкой stop_event (см. wake)
+        """
+        with self._not_empty:
+            self._watch_index()
+            while not stop_event.is_set():
+                with self._file_lock():
+                    if self._index:
+                        return True
+                self._not_empty.wait()
+        return False
 
-    def read_ready(self) -> List[str]:
+    def _watch_index(self) -> None:
+        """Запускает слежение за файлом индекса, если оно ещё не запущено. Вызывается под self.lock."""
+        if self._watcher is not None:
+            return
+        wm = WatchManager()
+        watcher = ThreadedNotifier(wm, _IndexChangeHandler(self))
+        watcher.daemon = True
+        watcher.start()
+        wm.add_watch(str(self.index_path.parent), _IndexChangeHandler.MASK)
+        self._watcher = watcher
+
+    def wake(self) -> None:
+        """Будит потоки в wait_pending, чтобы они перепроверили stop_event."""
+        with self._not_empty:
+            self._not_empty.notify_all()
+
+    def count_ready(self) -> int:
+        """Число записей, готовых к отправке сейчас."""
+        with self.lock, self._file_lock():
+            return bisect.bisect_left(self._index, (int(time.time()) + 1,))
+
+    def read_ready(self, limit: Optional[int] = None) -> List[list]:
+        """Забирает из очереди готовые записи (не больше limit, если задан).
+
+        Возвращает списки высказываний — по одному на запись очереди.
+
+        Записи старше settings.RETRY_MAX_AGE_SECONDS перед этим переносятся
+        в файл недоставленных (dead_path).
+        """
         now = int(time.time())
-        ready: List[str] = []
-        remaining_lines: List[str] = []
-        if not self.path.exists():
-            return ready
-        with self.lock:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        rec = json.loads(line)
-                    except Exception:
-                        # сломанные строки отбрасываем
+        ready: List[list] = []
+        with self.lock, self._file_lock():
+            # Обычный случай для ежедневного окна — готовых записей нет: не читаем файл вовсе
+            if not self._index or self._index[0][0] > now:
+                return ready
+            max_age = getattr(settings, 'RETRY_MAX_AGE_SECONDS', None)
+            if max_age:
+                self._expire(now - int(max_age))
+            cut = bisect.bisect_left(self._index, (now + 1,))
+            if limit is not None:
+                cut = min(cut, limit)
+            taken = self._index[:cut]
+            del self._index[:cut]
+            self._drop_entries(taken)
+            for (_, offset, _), line in self._read_lines(taken):
+                try:
+                    content = fastjson.loads(line)['content']
+                    if isinstance(content, str):
+                        # запись старого формата: содержимое хранилось строкой JSON
+                        content = fastjson.loads(content)
+                        if not isinstance(content, list):
+                            content = [content]
+                    ready.append(content)
+                except Exception as e:
+                    logger.warning("Пропущена повреждённая запись очереди (смещение %d): %s", offset, e)
+            # индекс перезаписывается только вместе с файлом очереди, в остальное время
+            # выданные записи отмечены надгробиями
+            if self._size - self._live_bytes > self._size * self.COMPACT_RATIO:
+                self._compact()
+                self._save_index()
+        return ready
+
+    def _read_lines(
+        self, entries: List[Tuple[int, int, int]],
+    ) -> Iterator[Tuple[Tuple[int, int, int], memoryview]]:
+        """Читает строки записей индекса вместе с переводом строки; выдаёт пары (запись, строка).
+
+        Записи, лежащие в файле подряд (в ежедневном режиме они так и идут), читаются
+        общими окнами до _READ_WINDOW байт и режутся на срезы memoryview без копирования,
+        так что в памяти одновременно не больше одного окна. Записи, байты которых
+        не совпадают с индексом, пропускаются с предупреждением.
+        """
+        fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            i = 0
+            while i < len(entries):
+                start = end = entries[i][1]
+                j = i
+                while j < len(entries) and entries[j][1] == end and (
+                    j == i or end - start + entries[j][2] + 1 <= _READ_WINDOW
+                ):
+                    end += entries[j][2] + 1
+                    j += 1
+                view = memoryview(_pread_full(fd, end - start, start))
+                for entry in entries[i:j]:
+                    _, offset, length = entry
+                    line = view[offset - start:offset - start + length + 1]
+                    if len(line) != length + 1 or line[-1] != ord('\n'):
+                        logger.warning("Запись индекса не совпадает с файлом очереди (смещение %d), пропущена", offset)
                         continue
-                    if int(rec.get('ready_at', 0)) <= now and rec.get('content'):
-                        ready.append(rec['content'])
-                    else:
-                        remaining_lines.append(line)
+                    yield entry, line
+                i = j
+        finally:
+            os.close(fd)
 
-            # перезаписываем файл оставшимися строками
-            with open(self.path, 'w', encoding='utf-8') as f:
-                if remaining_lines:
-                    f.write('\n'.join(remaining_lines) + '\n')
-        return ready
-    
-    def _save_to_sink(self, content_json: str) -> None:
-        """Сохраняет содержимое в файл результатов (sink file)."""
-        sink_file = getattr(settings, 'RETRY_SINK_FILE', None)
-        if not sink_file:
+    def _expire(self, cutoff: int) -> None:
+        """Переносит записи с ready_at < cutoff в dead_path. Вызывается под блокировками."""
+        cut = bisect.bisect_left(self._index, (cutoff,))
+        if not cut:
             return
-        
+        expired = self._index[:cut]
+        del self._index[:cut]
+        with open(self.dead_path, 'ab') as dead:
+            for _, line in self._read_lines(expired):
+                dead.write(line)
+        self._drop_entries(expired)
+        logger.warning("%d записей старше срока хранения перенесены в %s", len(expired), self.dead_path)
+
+    def _compact(self) -> None:
+        """Переписывает файл только живыми записями. Вызывается под блокировками.
+
+        Записи переносятся во временный файл потоком, окнами _read_lines.
+        """
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        index: List[Tuple[int, int, int]] = []
+        pos = 0
+        with open(tmp_path, 'wb') as out:
+            for (ready_at, _, length), line in self._read_lines(self._index):
+                out.write(line)
+                index.append((ready_at, pos, length))
+                pos += length + 1
+            # данные должны быть на диске до замены, иначе сбой может оставить пустой файл очереди
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+        os.close(self._fd)
+        self._fd = self._open_append(self.path)
+        self._ino = os.fstat(self._fd).st_ino
+        self._index = index
+        self._size = pos
+        self._live_bytes = pos
+
+    def _save_to_sink(self, payloads: List[list], sink_file: Optional[str] = None) -> None:
+        """Сохраняет пакет записей очереди в файл результатов (sink file) одной записью."""
+        sink_file = sink_file or getattr(settings, 'RETRY_SINK_FILE', None)
+        if not sink_file or not payloads:
+            return
+
+        # По одному высказыванию на строку, весь пакет — одним write(). Высказывания
+        # сериализуются заново: содержимое записи очереди всегда список, и исходные байты
+        # отдельного высказывания из него без разбора не выделить
+        buf = bytearray()
+        for payload in payloads:
+            for stmt in payload:
+                buf += fastjson.dumps(stmt)
+                buf += b'\n'
+
         sink_path = Path(sink_file)
         sink_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(sink_path, 'a', encoding='utf-8') as f:
-            try:
-                parsed = json.loads(content_json)
-                if isinstance(parsed, list):
-                    for stmt in parsed:
-                        f.write(json.dumps(stmt, ensure_ascii=False) + '\n')
-                else:
-                    f.write(json.dumps(parsed, ensure_ascii=False) + '\n')
-            except Exception:
-                # если не удалось распарсить, пишем как есть одной строкой
-                f.write(content_json + '\n')
-        
-        logger.info(f"Сохранены ретрай-записи в {sink_file}")
+        with open(sink_path, 'ab') as f:
+            f.write(buf)
+
+        logger.info("Сохранены %d ретрай-записей в %s", len(payloads), sink_file)
 
 
 class RetryQueueWorker(threading.Thread):
@@ -104,134 +606,164 @@ class RetryQueueWorker(threading.Thread):
 
     Ежедневный режим: раз в день в указанное время (settings.RETRY_DAILY_AT='HH:MM')
     пробует сначала одну запись; при успехе — отправляет остальные; при неуспехе — ждёт
-    следующего дня, ничего не делая.
+    следующего дня, ничего не делая. Пока очередь пуста, воркер не просыпается по
+    расписанию, а ждёт первой записи и только затем — ближайшего окна.
     """
 
     daemon = True
 
-    def __init__(self) -> None:
+    def __init__(self, queue: RetryQueue) -> None:
         super().__init__(name='RetryQueueWorker')
-        self.queue = RetryQueue()
+        # Очередь передаётся явно: воркер работает с тем же экземпляром, что и отправитель
+        self.queue = queue
         self.interval = int(getattr(settings, 'RETRY_WORKER_INTERVAL_SECONDS', 300))
         self._stop_event = threading.Event()
         self.sink_file = getattr(settings, 'RETRY_SINK_FILE', None)
-
-    def stop(self) -> None:
-        self._stop_event.set()
-
-    def run(self) -> None:
+        self.batch_size = int(getattr(settings, 'RETRY_BATCH_SIZE', 500) or 500)
         #Если не задано — используем 03:00 по умолчанию
         daily_at = getattr(settings, 'RETRY_DAILY_AT', '03:00')
         try:
-            hh, mm = map(int, str(daily_at).split(':'))
+            self.daily_hour, self.daily_minute = map(int, str(daily_at).split(':'))
         except Exception:
             logger.error("Неверный формат RETRY_DAILY_AT, ожидается 'HH:MM'")
-            hh = 3
-            mm = 0
+            self.daily_hour = 3
+            self.daily_minute = 0
 
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.queue.wake()
+
+    def _seconds_until_window(self) -> float:
+        """Возвращает число секунд до ближайшего HH:MM по локальному времени."""
+        now = datetime.now()
+        target = now.replace(hour=self.daily_hour, minute=self.daily_minute, second=0, microsecond=0)
+        if target <= now:
+            target += timedelta(days=1)
+        # timestamp() учитывает переход на летнее/зимнее время между now и target
+        return max(0.0, target.timestamp() - now.timestamp())
+
+    def run(self) -> None:
         while not self._stop_event.is_set():
             try:
+                # Пустая очередь: просыпаться в окно незачем — ждём первую запись
+                if not self.queue.wait_pending(self._stop_event):
+                    return
                 # Ждём до ближайшего HH:MM
-                now = time.localtime()
-                target_tuple = (now.tm_year, now.tm_mon, now.tm_mday, hh, mm, 0,
-                                now.tm_wday, now.tm_yday, now.tm_isdst)
-                target = time.mktime(time.struct_time(target_tuple))
-                now_ts = time.mktime(now)
-                if target <= now_ts:
-                    target += 24 * 60 * 60
-                sleep_for = max(0, int(target - now_ts))
-                for _ in range(sleep_for):
-                    if self._stop_event.is_set():
-                        return
-                    time.sleep(1)
-
-                # Наступило окно: читаем текущие готовые
-                ready_contents = self.queue.read_ready()
-                if not ready_contents:
+                sleep_for = self._seconds_until_window()
+                if self._stop_event.wait(timeout=sleep_for):
+                    return
+
+                # Наступило окно: пробуем одну готовую запись
+                first = self.queue.read_ready(limit=1)
+                if not first:
                     # ничего не готово — ждём следующего дня
                     continue
 
-                first = ready_contents[:1]
-                rest = ready_contents[1:]
-                ok = self._process_batch(first)
-                if ok and rest:
-                    self._process_batch(rest)
-                elif not ok and rest:
-                    # вернём остальные в очередь ещё раз
-                    for content_json in rest:
-                        self.queue.enqueue(content_json)
+                # Остальные забираем только при успехе, иначе они остаются в очереди
+                # с прежним ready_at и со временем уходят по сроку хранения
+                if self._process_batch(first):
+                    self._drain()
                 # затем снова ждём следующего дня
                 continue
             except Exception:
                 logger.exception("Сбой фонового воркера очереди, продолжаем")
                 # Спим минуту и пробуем пересчитать окно
-                for _ in range(60):
-                    if self._stop_event.is_set():
-                        return
-                    time.sleep(1)
+                if self._stop_event.wait(timeout=60):
+                    return
+
+    def _drain(self) -> None:
+        """Отправляет готовые записи порциями по batch_size.
 
-    def _process_batch(self, contents: List[str]) -> bool:
+        Очередь не разбирается в память целиком: в каждый момент держим только одну
+        порцию. Число записей фиксируется заранее — переочередённые при сбое записи
+        встают в конец индекса и в этом окне повторно не читаются.
+        """
+        remaining = self.queue.count_ready()
+        while remaining > 0 and not self._stop_event.is_set():
+            batch = self.queue.read_ready(limit=min(remaining, self.batch_size))
+            if not batch:
+                break
+            remaining -= len(batch)
+            self._process_batch(batch)
+
+    def _process_batch(self, payloads: List[list]) -> bool:
+        if self.sink_file:
+            try:
+                self.queue._save_to_sink(payloads, self.sink_file)
+            except Exception as e:
+                logger.error("Ошибка записи в %s: %s", self.sink_file, e)
+                return False
+            return True
+
+        from xapi_bridge import client  # type: ignore
         all_ok = True
-        for content_json in contents:
+        # Высказывания всех записей отправляем пачками не больше batch_size штук, а не по записи;
+        # запись, которая сама больше batch_size, уходит отдельным запросом
+        chunk_payloads: List[list] = []
+        chunk_statements: list = []
+        for payload in payloads:
+            if chunk_payloads and len(chunk_statements) + len(payload) > self.batch_size:
+                all_ok = self._send(client, chunk_payloads, chunk_statements) and all_ok
+                chunk_payloads, chunk_statements = [], []
+            chunk_payloads.append(payload)
+            chunk_statements.extend(payload)
+        if chunk_payloads:
+            all_ok = self._send(client, chunk_payloads, chunk_statements) and all_ok
+        return all_ok
+
+    def _send(self, client, payloads: List[list], statements: list) -> bool:
+        """Отправляет высказывания одним запросом; payloads — исходные записи для переочередения."""
+        try:
+            response: LRSResponse = client.lrs_publisher.lrs.save_statements(statements)
+        except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, TimeoutError) as net_err:
+            # transient сетевые ошибки — вернём обратно
+            logger.warning("Сетевая ошибка при повторной отправке: %s", net_err)
+            self._requeue(payloads)
+            return False
+        except Exception as send_err:
+            # Прочие ошибки сохраним в лог, не теряем запись
+            logger.error("Ошибка при отправке из очереди: %s", send_err)
+            self._requeue(payloads)
+            return False
+
+        if response.success:
+            logger.info("Успешная повторная отправка из очереди: %d высказываний", len(statements))
+            return True
+
+        status = getattr(response.response, 'status', None)
+        # 404 и повторяемые статусы — переочередяем
+        if (
+            client.lrs_publisher.backend.is_not_found(status, str(response.data))
+            or status in LRS_RETRYABLE_STATUSES
+        ):
+            # Учитываем Retry-After если доступно
+            delay_seconds = None
             try:
-                if self.sink_file:
-                    Path(self.sink_file).parent.mkdir(parents=True, exist_ok=True)
-                    with open(self.sink_file, 'a', encoding='utf-8') as f:
+                getheader = getattr(response.response, 'getheader', None)
+                if callable(getheader):
+                    ra = getheader('Retry-After')
+                    if ra:
                         try:
-                            parsed = json.loads(content_json)
-                            if isinstance(parsed, list):
-                                for stmt in parsed:
-                                    f.write(json.dumps(stmt, ensure_ascii=False) + '\n')
-                            else:
-                                f.write(json.dumps(parsed, ensure_ascii=False) + '\n')
+                            delay_seconds = int(ra)
                         except Exception:
-                            # если не удалось распарсить, пишем как есть одной строкой
-                            f.write(content_json + '\n')
-                    logger.info(f"Сохранены ретрай-записи в {self.sink_file}")
-                else:
-                    from xapi_bridge import client  # type: ignore
-                    payload = json.loads(content_json)
-                    try:
-                        response: LRSResponse = client.lrs_publisher.lrs.save_statements(payload)
-                        if not response.success:
-                            status = getattr(response.response, 'status', None)
-                            all_ok = False
-                            # 404 и повторяемые статусы — переочередяем
-                            if (
-                                client.lrs_publisher.backend.is_not_found(status, str(response.data))
-                                or status in {408, 429, 500, 502, 503, 504}
-                            ):
-                                # Учитываем Retry-After если доступно
-                                delay_seconds = None
-                                try:
-                                    getheader = getattr(response.response, 'getheader', None)
-                                    if callable(getheader):
-                                        ra = getheader('Retry-After')
-                                        if ra:
-                                            try:
-                                                delay_seconds = int(ra)
-                                            except Exception:
-                                                delay_seconds = None
-                                except Exception:
-                                    pass
-                                self.queue.enqueue(content_json, delay_seconds=delay_seconds)
-                            else:
-                                logger.error(f"Ошибка повторной отправки: {status} {response.data}")
-                        else:
-                            logger.info("Успешная повторная отправка из очереди")
-                    except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, TimeoutError) as net_err:
-                        # transient сетевые ошибки — вернём обратно
-                        all_ok = False
-                        logger.warning(f"Сетевая ошибка при повторной отправке: {net_err}")
-                        self.queue.enqueue(content_json)
-                    except Exception as send_err:
-                        # Прочие ошибки сохраним в лог, не теряем запись
-                        all_ok = False
-                        logger.error(f"Ошибка при отправке из очереди: {send_err}")
-                        self.queue.enqueue(content_json)
-            except Exception as e:
-                all_ok = False
-                logger.error(f"Ошибка при повторной отправке из очереди: {e}")
-        return all_ok
+                            delay_seconds = None
+            except Exception:
+                pass
+            self._requeue(payloads, delay_seconds=delay_seconds)
+            return False
+
+        if len(payloads) > 1:
+            # LRS отклонил пачку целиком — отправляем записи по одной, чтобы изолировать проблемную
+            logger.warning("Пачка из %d записей отклонена (%s), отправляем по одной", len(payloads), status)
+            all_ok = True
+            for payload in payloads:
+                all_ok = self._send(client, [payload], payload) and all_ok
+            return all_ok
 
+        logger.error("Ошибка повторной отправки: %s %s", status, response.data)
+        return False
 
+    def _requeue(self, payloads: List[list], delay_seconds: Optional[int] = None) -> None:
+        for payload in payloads:
+            self.queue.enqueue(payload, delay_seconds=delay_seconds)
+        logger.info("Возвращено в очередь повторной отправки: %d записей", len(payloads))
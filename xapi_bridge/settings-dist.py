@@ -71,6 +71,14 @@ RETRY_SINK_FILE: Optional[str] = None
 # (сначала 1 запись, если успех — затем остальные; при неуспехе — до следующего дня).
 RETRY_DAILY_AT: Optional[str] = '03:00'
 
+# Срок хранения записи в очереди ретраев (в секундах). Более старые записи
+# переносятся в файл <очередь>.dead рядом с файлом очереди.
+RETRY_MAX_AGE_SECONDS: Optional[int] = 7 * 86400
+
+# Максимальное число высказываний в одном запросе к LRS при отправке из очереди;
+# столько же записей очереди воркер читает в память за один проход
+RETRY_BATCH_SIZE: int = 500
+
 # =============================================
 #  Настройки кэширования
 # =============================================
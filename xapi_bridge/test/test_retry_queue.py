@@ -0,0 +1,333 @@
+"""
+Тесты файловой очереди повторной отправки: формат файлов на диске и восстановление.
+
+Запуск: python -m unittest xapi_bridge.test.test_retry_queue
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import xapi_bridge
+from xapi_bridge import retry_queue
+from xapi_bridge.retry_queue import RetryQueue, RetryQueueWorker, index_path_for, read_index_file
+
+
+class RetryQueueTestCase(unittest.TestCase):
+    """Каждый тест работает с отдельным файлом очереди во временном каталоге."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = Path(self.tmp.name) / 'retry.jsonl'
+        self.settings = types.SimpleNamespace(
+            RETRY_DAILY_AT='03:00', RETRY_MAX_AGE_SECONDS=None, RETRY_SINK_FILE=None, RETRY_BATCH_SIZE=3,
+        )
+        patcher = mock.patch.object(retry_queue, 'settings', self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_queue(self):
+        queue = RetryQueue(self.path)
+        self.addCleanup(queue.close)
+        return queue
+
+    def write_lines(self, *lines):
+        with open(self.path, 'ab') as f:
+            for line in lines:
+                f.write(line)
+
+
+class EnqueueTest(RetryQueueTestCase):
+
+    def test_round_trip(self):
+        queue = self.make_queue()
+        queue.enqueue('[{"a": 1}]')
+        queue.enqueue(b'{"b": 2}')
+        queue.enqueue([{'c': 3}])
+        self.assertEqual(queue.read_ready(), [[{'a': 1}], [{'b': 2}], [{'c': 3}]])
+        self.assertEqual(queue.read_ready(), [])
+
+    def test_multiline_content_stays_on_one_line(self):
+        queue = self.make_queue()
+        queue.enqueue('[\n  {"a": "x\\ny"}\n]')
+        self.assertEqual(self.path.read_bytes().count(b'\n'), 1)
+        self.assertEqual(queue.read_ready(), [[{'a': 'x\ny'}]])
+
+    def test_invalid_content_is_rejected(self):
+        queue = self.make_queue()
+        for content in ('not json at all', b'[\xff]', b''):
+            with self.subTest(content=content):
+                with self.assertRaises(ValueError):
+                    queue.enqueue(content)
+        self.assertEqual(self.path.read_bytes(), b'')
+
+    def test_consumed_records_are_not_returned_after_restart(self):
+        queue = self.make_queue()
+        for i in range(5):
+            queue.enqueue([i])
+        self.assertEqual(queue.read_ready(limit=2), [[0], [1]])
+        self.assertEqual(self.make_queue().read_ready(), [[2], [3], [4]])
+
+    def test_expired_records_move_to_dead_file(self):
+        queue = self.make_queue()
+        queue.enqueue([1])
+        self.settings.RETRY_MAX_AGE_SECONDS = 60
+        with mock.patch.object(retry_queue.time, 'time', return_value=time.time() + 3600):
+            self.assertEqual(queue.read_ready(), [])
+        dead_path = self.path.with_name('retry.jsonl.dead')
+        self.assertEqual(len(dead_path.read_bytes().splitlines()), 1)
+        self.assertEqual(self.make_queue().read_ready(), [])
+
+
+class RecoveryTest(RetryQueueTestCase):
+
+    def test_old_format_records(self):
+        self.write_lines(
+            b'{"content": "[{\\"a\\": 1}]", "ready_at": 0}\n',
+            b'{"content": "{\\"b\\": 2}", "ready_at": 0}\n',
+        )
+        self.assertEqual(self.make_queue().read_ready(), [[{'a': 1}], [{'b': 2}]])
+
+    def test_missing_index_is_rebuilt(self):
+        queue = self.make_queue()
+        queue.enqueue([1])
+        queue.enqueue([2])
+        index_path_for(self.path).unlink()
+        self.assertEqual(self.make_queue().read_ready(), [[1], [2]])
+
+    def test_stale_index_picks_up_unindexed_tail(self):
+        self.make_queue().enqueue([1])
+        # строка, дописанная в обход индекса (например, писатель упал до записи индекса)
+        self.write_lines(b'{"content":[2],"ready_at":0}\n')
+        self.assertEqual(self.make_queue().read_ready(), [[2], [1]])
+
+    def test_index_longer_than_queue_is_rebuilt(self):
+        queue = self.make_queue()
+        queue.enqueue([1])
+        queue.enqueue([2])
+        # файл очереди короче, чем покрывает индекс
+        first_line = self.path.read_bytes().split(b'\n')[0] + b'\n'
+        self.path.write_bytes(first_line)
+        self.assertEqual(self.make_queue().read_ready(), [[1]])
+
+    def test_corrupt_index_is_rebuilt(self):
+        queue = self.make_queue()
+        queue.enqueue([1])
+        index_path_for(self.path).write_bytes(b'\x00' * 5)
+        self.assertEqual(self.make_queue().read_ready(), [[1]])
+
+    def test_partial_index_entry_keeps_tombstones(self):
+        queue = self.make_queue()
+        for i in range(5):
+            queue.enqueue([i])
+        self.assertEqual(queue.read_ready(limit=2), [[0], [1]])
+        # сбой посреди дозаписи в индекс оставляет оборванную запись
+        with open(index_path_for(self.path), 'ab') as f:
+            f.write(b'\x00' * 5)
+        restarted = self.make_queue()
+        restarted.enqueue([5])
+        self.assertEqual(restarted.read_ready(), [[2], [3], [4], [5]])
+        self.assertEqual(self.make_queue().read_ready(), [])
+
+    def test_partial_index_entry_from_another_writer(self):
+        first, second = self.make_queue(), self.make_queue()
+        for i in range(3):
+            first.enqueue([i])
+        self.assertEqual(first.read_ready(limit=1), [[0]])
+        with open(index_path_for(self.path), 'ab') as f:
+            f.write(b'\x00' * 5)
+        second.enqueue([3])
+        self.assertEqual(first.read_ready(), [[1], [2], [3]])
+        self.assertEqual(self.make_queue().read_ready(), [])
+
+    def test_truncated_last_line(self):
+        self.make_queue().enqueue([1])
+        self.write_lines(b'{"content":[2],"ready')
+        queue = self.make_queue()
+        queue.enqueue([3])
+        self.assertEqual(queue.read_ready(), [[1], [3]])
+        self.assertEqual(self.make_queue().read_ready(), [])
+
+    def test_corrupt_record_is_logged(self):
+        queue = self.make_queue()
+        queue.enqueue([1])
+        data = self.path.read_bytes()
+        self.path.write_bytes(b'#' + data[1:])
+        with self.assertLogs(retry_queue.logger, level='WARNING'):
+            self.assertEqual(queue.read_ready(), [])
+
+
+class CompactionTest(RetryQueueTestCase):
+
+    def fill(self, queue, count):
+        for i in range(count):
+            queue.enqueue([{'i': i}])
+
+    def test_compaction_keeps_live_records(self):
+        queue = self.make_queue()
+        self.fill(queue, 10)
+        size = self.path.stat().st_size
+        self.assertEqual(len(queue.read_ready(limit=6)), 6)
+        self.assertLess(self.path.stat().st_size, size)
+        entries, covered, ino = read_index_file(index_path_for(self.path))
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(covered, self.path.stat().st_size)
+        self.assertEqual(ino, self.path.stat().st_ino)
+        self.assertEqual(self.make_queue().read_ready(), [[{'i': i}] for i in range(6, 10)])
+
+    def test_compaction_streams_in_bounded_windows(self):
+        queue = self.make_queue()
+        self.fill(queue, 10)
+        with mock.patch.object(retry_queue, '_READ_WINDOW', 100), \
+                mock.patch.object(retry_queue.os, 'pread', wraps=os.pread) as pread:
+            queue.read_ready(limit=6)
+        self.assertTrue(all(call.args[1] <= 100 for call in pread.call_args_list))
+        self.assertEqual(self.make_queue().read_ready(), [[{'i': i}] for i in range(6, 10)])
+
+    def test_reads_between_compactions_only_append_to_index(self):
+        queue = self.make_queue()
+        self.fill(queue, 10)
+        index_path = index_path_for(self.path)
+        ino = index_path.stat().st_ino
+        queue.read_ready(limit=1)
+        queue.read_ready(limit=1)
+        self.assertEqual(index_path.stat().st_ino, ino)
+
+    def test_crash_between_queue_replace_and_index_save(self):
+        queue = self.make_queue()
+        self.fill(queue, 10)
+        with mock.patch.object(RetryQueue, '_save_index', side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                queue.read_ready(limit=6)
+        self.assertEqual(self.make_queue().read_ready(), [[{'i': i}] for i in range(6, 10)])
+
+
+class SharedFileTest(RetryQueueTestCase):
+
+    def test_close_releases_descriptors(self):
+        fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        with RetryQueue(self.path) as queue:
+            queue.enqueue([1])
+        queue.close()
+        if fds is not None:
+            self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+        self.assertEqual(self.make_queue().read_ready(), [[1]])
+
+    def test_interleaved_writers(self):
+        first, second = self.make_queue(), self.make_queue()
+        first.enqueue(['a1'])
+        second.enqueue(['b1'])
+        first.enqueue(['a2'])
+        self.assertEqual(first.read_ready(), [['a1'], ['b1'], ['a2']])
+        self.assertEqual(second.read_ready(), [])
+        self.assertEqual(self.make_queue().read_ready(), [])
+
+    def wait_in_thread(self, queue, stop_event):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(queue.wait_pending(stop_event)))
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, result
+
+    def test_wait_pending_wakes_on_another_writer(self):
+        first, second = self.make_queue(), self.make_queue()
+        stop_event = threading.Event()
+        self.addCleanup(stop_event.set)
+        thread, result = self.wait_in_thread(first, stop_event)
+        thread.join(0.2)
+        self.assertEqual(result, [])
+        second.enqueue([1])
+        thread.join(5)
+        self.assertEqual(result, [True])
+
+    def test_wait_pending_stops_on_wake(self):
+        queue = self.make_queue()
+        stop_event = threading.Event()
+        thread, result = self.wait_in_thread(queue, stop_event)
+        stop_event.set()
+        queue.wake()
+        thread.join(5)
+        self.assertEqual(result, [False])
+
+    def test_compaction_by_another_instance(self):
+        first, second = self.make_queue(), self.make_queue()
+        for i in range(10):
+            first.enqueue([i])
+        first.read_ready(limit=8)
+        second.enqueue([10])
+        self.assertEqual(second.count_ready(), 3)
+        self.assertEqual(second.read_ready(), [[8], [9], [10]])
+        self.assertEqual(first.read_ready(), [])
+
+
+class WorkerSendTest(RetryQueueTestCase):
+    """Отправка записей очереди в LRS воркером через подменённый client."""
+
+    def setUp(self):
+        super().setUp()
+        self.queue = self.make_queue()
+        self.worker = RetryQueueWorker(self.queue)
+        self.calls = []
+        self.respond = lambda statements: self.response(True)
+        client = types.SimpleNamespace(lrs_publisher=types.SimpleNamespace(
+            lrs=types.SimpleNamespace(save_statements=self.save_statements),
+            backend=types.SimpleNamespace(is_not_found=lambda status, data: status == 404),
+        ))
+        for patcher in (
+            mock.patch.dict(sys.modules, {'xapi_bridge.client': client}),
+            mock.patch.object(xapi_bridge, 'client', client, create=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def response(success, status=200):
+        return types.SimpleNamespace(
+            success=success,
+            data='',
+            response=types.SimpleNamespace(status=status, getheader=lambda name: None),
+        )
+
+    def save_statements(self, statements):
+        self.calls.append(list(statements))
+        return self.respond(statements)
+
+    def test_bulk_success(self):
+        self.assertTrue(self.worker._process_batch([['a'], ['b'], ['c']]))
+        self.assertEqual(self.calls, [['a', 'b', 'c']])
+        self.assertEqual(self.queue.read_ready(), [])
+
+    def test_requests_do_not_exceed_batch_size(self):
+        self.assertTrue(self.worker._process_batch([['a', 'b'], ['c', 'd'], ['e']]))
+        self.assertEqual(self.calls, [['a', 'b'], ['c', 'd', 'e']])
+
+    def test_oversized_record_is_sent_alone(self):
+        self.assertTrue(self.worker._process_batch([['a'], ['b', 'c', 'd', 'e'], ['f']]))
+        self.assertEqual(self.calls, [['a'], ['b', 'c', 'd', 'e'], ['f']])
+
+    def test_retryable_status_requeues_records(self):
+        self.respond = lambda statements: self.response(False, 503)
+        self.assertFalse(self.worker._process_batch([['a'], ['b']]))
+        self.assertEqual(self.calls, [['a', 'b']])
+        self.assertEqual(self.queue.read_ready(), [['a'], ['b']])
+
+    def test_rejected_batch_falls_back_to_single_records(self):
+        def respond(statements):
+            rejected = len(statements) > 1 or statements == ['bad']
+            return self.response(not rejected, 400 if rejected else 200)
+        self.respond = respond
+        self.assertFalse(self.worker._process_batch([['a'], ['bad'], ['c']]))
+        self.assertEqual(self.calls, [['a', 'bad', 'c'], ['a'], ['bad'], ['c']])
+        # отклонённая LRS запись не переочередяется
+        self.assertEqual(self.queue.read_ready(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()